@@ -1,10 +1,12 @@
 import streamlit as st
 import os
-import re
-from check_format import is_valid_student_id_file, EXPECTED_QUERIES
+from check_format import is_valid_student_id_file, parse_queries, EXPECTED_QUERIES
 
-import json
-import hashlib
+import orjson
+import queue
+import atexit
+import threading
+from blake3 import blake3
 from datetime import datetime
 from streamlit import runtime
 from streamlit.runtime.scriptrunner import get_script_run_ctx
@@ -12,12 +14,16 @@ from streamlit.runtime.scriptrunner import get_script_run_ctx
 # --- CONFIG ---
 QUERIES_DIR = "queries"
 SUBMISSIONS_LOG = "submissions_tracking.json"
+SUBMISSIONS_WAL = "submissions_wal.jsonl"
 EVENTS_LOG = "submission_events.log"
+PRETTY_TRACKING = False  # Indent submissions_tracking.json for hand-editing/debugging
+COMPACT_EVERY = 10  # Fold submissions_wal.jsonl into the snapshot after this many submissions
+
 os.makedirs(QUERIES_DIR, exist_ok=True)
 
 if not os.path.exists(SUBMISSIONS_LOG):
-    with open(SUBMISSIONS_LOG, "w") as f:
-        json.dump({"ip_to_id": {}, "id_to_ip": {}}, f)
+    with open(SUBMISSIONS_LOG, "wb") as f:
+        f.write(orjson.dumps({"ip_to_id": {}, "id_to_ip": {}, "id_to_hash": {}}))
 
 st.set_page_config(page_title="DBS Lab Query Submission")
 
@@ -38,57 +44,201 @@ def get_client_info():
     """Collects client information for logging."""
     try:
         headers = st.context.headers
+        user_agent = headers.get("User-Agent", "unknown")
         return {
             "host": headers.get("Host", "unknown"),
-            "user_agent": headers.get("User-Agent", "unknown"),
+            "user_agent": user_agent,
+            "ua60": user_agent[:60],
         }
     except Exception:
-        return {"host": "unknown", "user_agent": "unknown"}
+        return {"host": "unknown", "user_agent": "unknown", "ua60": "unknown"}
 
 def load_tracking():
-    with open(SUBMISSIONS_LOG, "r") as f:
-        data = json.load(f)
+    with open(SUBMISSIONS_LOG, "rb") as f:
+        data = orjson.loads(f.read())
         if "ip_to_id" not in data:
             data = {"ip_to_id": {}, "id_to_ip": {}}
+        data.setdefault("id_to_hash", {})
         return data
 
 def save_tracking(tracking):
-    with open(SUBMISSIONS_LOG, "w") as f:
-        json.dump(tracking, f, indent=4)
+    option = orjson.OPT_INDENT_2 if PRETTY_TRACKING else 0
+    # Write a temp file and swap it in, so a crash mid-write can't leave truncated JSON
+    tmp_path = SUBMISSIONS_LOG + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(tracking, option=option))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, SUBMISSIONS_LOG)
+
+def apply_submission(tracking, entry):
+    """Applies one submission log entry to the bidirectional mapping."""
+    tracking["ip_to_id"][entry["ip"]] = entry["id"]
+    tracking["id_to_ip"][entry["id"]] = entry["ip"]
+    if "hash" in entry:
+        tracking["id_to_hash"][entry["id"]] = entry["hash"]
+
+@st.cache_resource
+def get_tracking_store():
+    """Tracking state shared by all sessions; filled in by refresh_tracking."""
+    store = {
+        "tracking": None, "base": None, "mtime": None,
+        "lock": threading.Lock(), "wal": None, "pending": 0,
+    }
+    atexit.register(flush_tracking, store)
+    return store
+
+def compact_tracking(store):
+    """Writes the in-memory tracking to the snapshot and starts a fresh log (hold store["lock"])."""
+    # The log is only truncated below, once the new snapshot is safely in place
+    save_tracking(store["tracking"])
+    # What the snapshot holds now, to tell later instructor edits apart
+    store["base"] = {key: dict(mapping) for key, mapping in store["tracking"].items()}
+    if store["wal"] is not None:
+        store["wal"].close()
+    # Unbuffered: every entry reaches the file in a single write() call
+    store["wal"] = open(SUBMISSIONS_WAL, "wb", buffering=0)
+    store["pending"] = 0
+    store["mtime"] = os.stat(SUBMISSIONS_LOG).st_mtime_ns
+
+def flush_tracking(store):
+    """Folds any logged submissions into the snapshot when the server exits."""
+    with store["lock"]:
+        # Skip if nothing is pending, or if the snapshot was edited since we last read it
+        if store["pending"] and os.stat(SUBMISSIONS_LOG).st_mtime_ns == store["mtime"]:
+            compact_tracking(store)
+
+def refresh_tracking(store):
+    """Returns the in-memory tracking, rebuilding it only if the snapshot changed on disk (hold store["lock"])."""
+    # An unchanged mtime means nobody but us wrote the snapshot: skip the re-parse
+    mtime = os.stat(SUBMISSIONS_LOG).st_mtime_ns
+    if mtime == store["mtime"]:
+        return store["tracking"]
+
+    # First call, or the instructor edited the snapshot: reload it and replay
+    # the log on top, except for entries touching a mapping the instructor
+    # removed or changed, so unblocking one student doesn't undo the rest.
+    tracking = load_tracking()
+    base = store["base"]
+    if base is not None:
+        removed_ids = {k for k, v in base["id_to_ip"].items() if tracking["id_to_ip"].get(k) != v}
+        removed_ips = {k for k, v in base["ip_to_id"].items() if tracking["ip_to_id"].get(k) != v}
+    if os.path.exists(SUBMISSIONS_WAL):
+        with open(SUBMISSIONS_WAL, "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                    if base is None:
+                        # Startup: nothing to diff against, so keep only entries
+                        # written after the snapshot was last saved
+                        keep = datetime.fromisoformat(entry["ts"]).timestamp() * 1e9 > mtime
+                    else:
+                        keep = entry["id"] not in removed_ids and entry["ip"] not in removed_ips
+                    if keep:
+                        apply_submission(tracking, entry)
+                except (ValueError, KeyError):
+                    # Blank or torn line from an interrupted write
+                    pass
+
+    # Fold the replayed entries into the snapshot and start a fresh log
+    store["tracking"] = tracking
+    compact_tracking(store)
+    return tracking
+
+def record_submission(store, student_id, ip, content_hash):
+    """Updates the in-memory mapping and appends it to the log (hold store["lock"])."""
+    entry = {"ip": ip, "id": student_id, "hash": content_hash, "ts": datetime.now().isoformat()}
+    apply_submission(store["tracking"], entry)
+    store["wal"].write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+
+    # Keep the snapshot instructors read reasonably current
+    store["pending"] += 1
+    if store["pending"] >= COMPACT_EVERY:
+        compact_tracking(store)
+
+@st.cache_resource
+def get_event_queue():
+    """Starts the events log writer thread once per server process."""
+    events = queue.Queue()
+    log = open(EVENTS_LOG, "a", encoding="utf-8", buffering=1 << 16)
+
+    def writer():
+        while True:
+            line = events.get()
+            if line is None:
+                # Shutdown sentinel: everything queued before it has been written
+                break
+            log.write(line)
+            # Flush once the burst is over rather than after every line
+            if events.empty():
+                log.flush()
+        log.flush()
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+
+    def flush_pending():
+        events.put(None)
+        thread.join()
+
+    atexit.register(flush_pending)
+    return events
+
+_EVENT_LINE = "[%s] [%s] ID: %s | IP: %s | Host: %s | UA: %s... | %s\n"
 
 def log_event(event_type, student_id, ip, client_info, extra=""):
-    """Logs an event to the events log file."""
-    timestamp = datetime.now().isoformat()
-    log_line = (
-        f"[{timestamp}] [{event_type}] "
-        f"ID: {student_id} | IP: {ip} | "
-        f"Host: {client_info['host']} | "
-        f"UA: {client_info['user_agent'][:60]}... | "
-        f"{extra}\n"
+    """Queues an event for the events log file."""
+    timestamp = datetime.now().isoformat(timespec="seconds")
+    log_line = _EVENT_LINE % (
+        timestamp, event_type, student_id, ip,
+        client_info["host"], client_info["ua60"], extra
     )
-    with open(EVENTS_LOG, "a", encoding="utf-8") as log:
-        log.write(log_line)
+    get_event_queue().put(log_line)
 
 def get_content_hash(content):
-    """Returns a short hash of the content for change detection."""
-    return hashlib.md5(content.encode()).hexdigest()[:8]
+    """Returns the BLAKE3 hex digest of the raw content bytes for change detection."""
+    return blake3(content).hexdigest()
 
 import sqlglot
 from sqlglot import parse_one, exp
 from sqlglot.errors import ParseError
 
-def check_format_streamlit(content, expected_count):
+@st.cache_data(max_entries=2048, show_spinner=False)
+def check_oracle_syntax(sql):
+    """Returns a syntax warning for the query, or None if sqlglot parses it."""
+    # Cached across reruns and sessions: repeated clicks and shared boilerplate parse once
+    try:
+        parse_one(sql, read="oracle")
+    except ParseError as e:
+        return f"Potential Oracle syntax error: {str(e)[:100]}..."
+    except Exception:
+        return "Could not validate syntax (unexpected error)."
+    return None
+
+def check_format_streamlit(raw, expected_count):
     all_passed = True
     results = []
-    
+
+    # A file that is not valid UTF-8 is decoded the same way main.py reads the
+    # saved file, so the portal and the grader always split it the same way
+    try:
+        content = raw.decode("utf-8")
+        invalid_utf8 = False
+    except UnicodeDecodeError:
+        content = raw.decode("utf-8", errors="replace")
+        invalid_utf8 = True
+    queries = parse_queries(content, expected_count)
+
     for i in range(1, expected_count + 1):
         marker = f"--{i}--"
-        # Regex to find the marker and capture the query until the next marker or EOF
-        pattern = rf"{re.escape(marker)}\s*(.*?)\s*(?=--\d+--|$)"
-        match = re.search(pattern, content, re.DOTALL)
-        
-        if match:
-            query_text = match.group(1).strip()
+        query_text = queries[i]
+
+        if query_text is not None:
+            if invalid_utf8 and "\ufffd" in query_text:
+                results.append((i, "FAIL", f"Query after marker {marker} is not valid UTF-8 text."))
+                all_passed = False
+                continue
+
             if query_text:
                 status = "PASS"
                 msg = "Correctly formatted."
@@ -99,19 +249,12 @@ def check_format_streamlit(content, expected_count):
                     msg = "Marker found, but query might be missing a semicolon."
                 
                 # --- Syntax Checking (Oracle) ---
-                try:
-                    # Strip semicolon for parsing if it exists, as sqlglot handles single statements
-                    clean_sql = query_text.rstrip(';').strip()
-                    parse_one(clean_sql, read="oracle")
-                except ParseError as e:
+                # Strip semicolon for parsing if it exists, as sqlglot handles single statements
+                clean_sql = query_text.rstrip(';').strip()
+                syntax_msg = check_oracle_syntax(clean_sql)
+                if syntax_msg:
                     # If we already have a warning, we append to it, otherwise we downgrade to WARNING or stay FAIL
                     # Since syntax is a warning, we use WARNING status if it's not already FAIL
-                    syntax_msg = f"Potential Oracle syntax error: {str(e)[:100]}..."
-                    if status != "FAIL":
-                        status = "WARNING"
-                        msg = f"{msg} {syntax_msg}" if msg != "Correctly formatted." else syntax_msg
-                except Exception as e:
-                    syntax_msg = "Could not validate syntax (unexpected error)."
                     if status != "FAIL":
                         status = "WARNING"
                         msg = f"{msg} {syntax_msg}" if msg != "Correctly formatted." else syntax_msg
@@ -166,13 +309,13 @@ def main():
             st.info("Your file MUST be named as your Student ID (e.g., `2023A7PS0043H.sql`).")
             return
 
-        content = uploaded_file.read().decode("utf-8")
+        raw = uploaded_file.getvalue()
         
         col1, col2 = st.columns(2)
         
         with col1:
             if st.button("Check Format", use_container_width=True):
-                passed, results = check_format_streamlit(content, EXPECTED_QUERIES)
+                passed, results = check_format_streamlit(raw, EXPECTED_QUERIES)
                 st.session_state.format_passed = passed
                 st.session_state.check_done = True
                 st.session_state.results = results
@@ -181,58 +324,76 @@ def main():
             submit_disabled = not st.session_state.get("format_passed", False)
             if st.button("Submit Query", use_container_width=True, disabled=submit_disabled, type="primary"):
                 user_ip = get_remote_ip()
-                client_info = get_client_info()
-                tracking = load_tracking()
+                # Headers don't change within a session, so collect them once
+                if "client_info" not in st.session_state:
+                    st.session_state.client_info = get_client_info()
+                client_info = st.session_state.client_info
                 
                 # Extract Student ID from filename (e.g. 2023A7PS0043H)
                 student_id = filename.replace(".sql", "").upper()
-                content_hash = get_content_hash(content)
+                content_hash = get_content_hash(raw)
                 
-                # Rule 1: Check if this IP already submitted for a DIFFERENT ID
-                existing_id_for_ip = tracking["ip_to_id"].get(user_ip)
+                # Decide and record under one lock so concurrent sessions
+                # cannot both claim the same ID or IP
+                store = get_tracking_store()
+                with store["lock"]:
+                    tracking = refresh_tracking(store)
+
+                    # Rule 1: Check if this IP already submitted for a DIFFERENT ID
+                    existing_id_for_ip = tracking["ip_to_id"].get(user_ip)
                 
-                # Rule 2: Check if this ID was already submitted by a DIFFERENT IP
-                existing_ip_for_id = tracking["id_to_ip"].get(student_id)
+                    # Rule 2: Check if this ID was already submitted by a DIFFERENT IP
+                    existing_ip_for_id = tracking["id_to_ip"].get(student_id)
                 
-                if existing_id_for_ip and existing_id_for_ip != student_id:
-                    # This IP already submitted for a different student ID
-                    st.error(f"❌ **Blocking Submission:** You have already submitted for Student ID `{existing_id_for_ip}`. You cannot submit for a different ID.")
-                    log_event(
-                        "BLOCKED", student_id, user_ip, client_info,
-                        f"Reason: IP already linked to {existing_id_for_ip}"
-                    )
-                elif existing_ip_for_id and existing_ip_for_id != user_ip:
-                    # This student ID was already submitted from a different IP
-                    st.error(f"❌ **Blocking Submission:** Student ID `{student_id}` has already been submitted from a different IP address. If this is an error, contact the instructor.")
-                    log_event(
-                        "BLOCKED", student_id, user_ip, client_info,
-                        f"Reason: ID already claimed by IP {existing_ip_for_id}"
-                    )
-                else:
-                    # Check if this is a new submission or an update
-                    is_update = existing_id_for_ip == student_id
+                    if existing_id_for_ip and existing_id_for_ip != student_id:
+                        # This IP already submitted for a different student ID
+                        st.error(f"❌ **Blocking Submission:** You have already submitted for Student ID `{existing_id_for_ip}`. You cannot submit for a different ID.")
+                        log_event(
+                            "BLOCKED", student_id, user_ip, client_info,
+                            f"Reason: IP already linked to {existing_id_for_ip}"
+                        )
+                    elif existing_ip_for_id and existing_ip_for_id != user_ip:
+                        # This student ID was already submitted from a different IP
+                        st.error(f"❌ **Blocking Submission:** Student ID `{student_id}` has already been submitted from a different IP address. If this is an error, contact the instructor.")
+                        log_event(
+                            "BLOCKED", student_id, user_ip, client_info,
+                            f"Reason: ID already claimed by IP {existing_ip_for_id}"
+                        )
+                    elif (
+                        existing_ip_for_id == user_ip
+                        and existing_id_for_ip == student_id
+                        and tracking["id_to_hash"].get(student_id) == content_hash
+                        and os.path.exists(os.path.join(QUERIES_DIR, filename))
+                    ):
+                        # Byte-identical to the stored file and still bound to this IP, nothing to write
+                        st.info("Identical to your previous submission; no action taken.")
+                        log_event(
+                            "UNCHANGED", student_id, user_ip, client_info,
+                            f"Hash: {content_hash[:8]} | File: {filename}"
+                        )
+                    else:
+                        # Check if this is a new submission or an update
+                        is_update = existing_id_for_ip == student_id
                     
-                    # Store the file
-                    save_path = os.path.join(QUERIES_DIR, filename)
-                    with open(save_path, "w", encoding="utf-8") as f:
-                        f.write(content)
+                        # Store the file
+                        save_path = os.path.join(QUERIES_DIR, filename)
+                        with open(save_path, "wb") as f:
+                            f.write(raw)
                     
-                    # Update tracking (bidirectional mapping)
-                    tracking["ip_to_id"][user_ip] = student_id
-                    tracking["id_to_ip"][student_id] = user_ip
-                    save_tracking(tracking)
+                        # Update tracking (bidirectional mapping)
+                        record_submission(store, student_id, user_ip, content_hash)
                     
-                    event_type = "UPDATE" if is_update else "SUBMIT"
-                    log_event(
-                        event_type, student_id, user_ip, client_info,
-                        f"Hash: {content_hash} | File: {filename}"
-                    )
+                        event_type = "UPDATE" if is_update else "SUBMIT"
+                        log_event(
+                            event_type, student_id, user_ip, client_info,
+                            f"Hash: {content_hash[:8]} | File: {filename}"
+                        )
                     
-                    if is_update:
-                        st.success(f"✅ **Submission Updated!**")
-                        st.info(f"Your file `{filename}` has been updated.")
-                    else:
-                        st.success(f"✅ **Submission Successful!**")
+                        if is_update:
+                            st.success(f"✅ **Submission Updated!**")
+                            st.info(f"Your file `{filename}` has been updated.")
+                        else:
+                            st.success(f"✅ **Submission Successful!**")
 
         # Show results if check was performed
         if st.session_state.get("check_done", False):
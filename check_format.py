@@ -6,6 +6,9 @@ import os
 EXPECTED_QUERIES = 2
 # --------------------------------
 
+# e.g. 2023A7PS0043H.sql, which is always 17 characters long
+_ID_FILE_RE = re.compile(r"\A\d{4}[A-Z0-9]{4}\d{4}[A-Z]\.sql\Z", re.IGNORECASE)
+
 class Colors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -23,8 +26,33 @@ def print_banner():
     print(f"{Colors.HEADER}{Colors.BOLD}========================================={Colors.ENDC}\n")
 
 def is_valid_student_id_file(filename):
-    pattern = r"^\d{4}[A-Z0-9]{4}\d{4}[A-Z]\.sql$"
-    return re.match(pattern, filename, re.IGNORECASE) is not None
+    # Cheap length/suffix checks reject most bad names before the regex runs
+    return (
+        len(filename) == 17
+        and filename[-4:].lower() == '.sql'
+        and _ID_FILE_RE.match(filename) is not None
+    )
+
+def parse_queries(content, expected_count):
+    """Splits content on --N-- marker lines. Missing markers map to None."""
+    # Editors like Notepad prepend a BOM, which strip() would leave on the first marker
+    lines = content.removeprefix('\ufeff').splitlines(keepends=True)
+
+    # A marker is a line holding only --N--, so plain str checks are enough
+    markers = []
+    for idx, line in enumerate(lines):
+        s = line.strip()
+        num = s[2:-2]
+        if len(s) >= 5 and s.startswith('--') and s.endswith('--') and num.isascii() and num.isdigit():
+            markers.append((int(num), idx))
+
+    # Each body runs up to the next marker line; the first occurrence of a marker wins
+    found = {}
+    for pos, (num, start) in enumerate(markers):
+        end = markers[pos + 1][1] if pos + 1 < len(markers) else len(lines)
+        found.setdefault(num, ''.join(lines[start + 1:end]).strip())
+
+    return {i: found.get(i) for i in range(1, expected_count + 1)}
 
 def check_format(filename, expected_count):
     if not os.path.exists(filename):
@@ -47,14 +75,13 @@ def check_format(filename, expected_count):
     all_passed = True
     results = []
 
+    queries = parse_queries(content, expected_count)
+
     for i in range(1, expected_count + 1):
         marker = f"--{i}--"
-        # Regex to find the marker and capture the query until the next marker or EOF
-        pattern = rf"{re.escape(marker)}\s*(.*?)\s*(?=--\d+--|$)"
-        match = re.search(pattern, content, re.DOTALL)
-        
-        if match:
-            query_text = match.group(1).strip()
+        query_text = queries[i]
+
+        if query_text is not None:
             if query_text:
                 if not query_text.endswith(';'):
                     print(f"Query {i}: {Colors.WARNING}[WARN]{Colors.ENDC} Marker found, but query might be missing a semicolon.")
@@ -2,8 +2,14 @@ import oracledb
 import os
 import csv
 import traceback
-import re
-from pprint import pformat
+import hashlib
+import queue
+import io
+import orjson
+from blake3 import blake3
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from check_format import parse_queries
 
 # ---------------- CONFIG ----------------
 
@@ -19,8 +25,35 @@ OUTPUT_CSV = "results.csv"
 
 EXPECTED_QUERIES = 2  # Set this to the number of queries in the assignment
 
+# Students are evaluated in parallel, each worker in its own Oracle schema
+# (created on first run as EVAL_W1..EVAL_WN) so DDL never clobbers a peer.
+# ORACLE_DSN must be a PDB service; on a CDB root use the prefix "C##EVAL_W".
+NUM_WORKERS = 8
+WORKER_USER_PREFIX = "EVAL_W"
+WORKER_PASSWORD = "manager"
+WORKER_PRIVILEGES = (
+    "CREATE SESSION, CREATE TABLE, CREATE VIEW, CREATE SEQUENCE, CREATE TRIGGER, "
+    "CREATE PROCEDURE, CREATE SYNONYM, CREATE TYPE"
+)
+
 # ---------------------------------------
 
+# Leading keywords of queries that only read data, and of DML that a
+# rollback fully undoes. Anything else is treated as DDL.
+READ_ONLY_KEYWORDS = {"select", "with"}
+DML_KEYWORDS = {"insert", "update", "delete", "merge"}
+
+# Rows fetched per round-trip when streaming query results
+FETCH_ARRAY_SIZE = 1000
+
+# Statements per anonymous PL/SQL block when replaying a script
+SCRIPT_BLOCK_SIZE = 50
+# PL/SQL string literals are capped at 32767 bytes; longer statements run on their own
+MAX_BATCHED_STATEMENT = 32000
+
+# (sha1 of file content, expected count) -> parsed queries
+_parse_cache = {}
+
 
 def connect():
     return oracledb.connect(
@@ -30,43 +63,125 @@ def connect():
     )
 
 
-def run_sql_script(cursor, path):
+def create_worker_users(cursor):
+    users = []
+    for n in range(1, NUM_WORKERS + 1):
+        user = f"{WORKER_USER_PREFIX}{n}"
+        try:
+            cursor.execute(
+                f'CREATE USER {user} IDENTIFIED BY "{WORKER_PASSWORD}" '
+                f'QUOTA UNLIMITED ON USERS'
+            )
+        except oracledb.DatabaseError as e:
+            (error,) = e.args
+            # ORA-01920: the user is left over from a previous run. Anything else
+            # (e.g. ORA-65096 when ORACLE_DSN points at a CDB root) is fatal.
+            if error.code != 1920:
+                raise
+        # Enough for schema.sql to create the usual lab objects (sequences, triggers, ...)
+        cursor.execute(f"GRANT {WORKER_PRIVILEGES} TO {user}")
+        users.append(user)
+    return users
+
+
+def create_pool():
+    # Heterogeneous pool: each acquire() names the worker schema it logs in as
+    return oracledb.create_pool(
+        dsn=ORACLE_DSN,
+        min=0,
+        max=NUM_WORKERS,
+        increment=1,
+        homogeneous=False
+    )
+
+
+def build_script_block(statements):
+    # Each statement keeps its own handler: Oracle doesn't have 'IF NOT EXISTS',
+    # so we might ignore some errors during schema setup without skipping the rest.
+    body = "\n".join(
+        "BEGIN EXECUTE IMMEDIATE '{}'; EXCEPTION WHEN OTHERS THEN NULL; END;".format(
+            stmt.replace("'", "''")
+        )
+        for stmt in statements
+    )
+    return f"BEGIN\n{body}\nEND;"
+
+
+@lru_cache(maxsize=None)
+def load_sql_script(path):
     with open(path, "r", encoding="utf-8") as f:
         sql = f.read()
 
     # Split by semicolon but ignore ones inside strings (simplified)
     # For actual labs, students usually write simple queries
     statements = [s.strip() for s in sql.split(";") if s.strip()]
+
+    # Pack the statements into a few anonymous blocks so a replay costs one
+    # round-trip per block instead of one per statement. Returns
+    # (block, statements) pairs; block is None for a statement too long for
+    # a PL/SQL string literal, which is then executed directly.
+    chunks = []
+    batch = []
     for stmt in statements:
-        try:
-            cursor.execute(stmt)
-        except Exception:
-            # Oracle doesn't have 'IF NOT EXISTS', so we might ignore some errors during schema setup
-            pass
+        if len(stmt.replace("'", "''").encode("utf-8")) > MAX_BATCHED_STATEMENT:
+            if batch:
+                chunks.append((build_script_block(batch), batch))
+                batch = []
+            chunks.append((None, [stmt]))
+            continue
+        batch.append(stmt)
+        if len(batch) == SCRIPT_BLOCK_SIZE:
+            chunks.append((build_script_block(batch), batch))
+            batch = []
+    if batch:
+        chunks.append((build_script_block(batch), batch))
+    return chunks
+
+
+def run_sql_script(cursor, path):
+    for block, statements in load_sql_script(path):
+        if block is not None:
+            try:
+                cursor.execute(block)
+                continue
+            except Exception:
+                # The block failed to compile, so none of it ran: retry statement by statement
+                pass
+
+        for stmt in statements:
+            try:
+                cursor.execute(stmt)
+            except Exception:
+                # Oracle doesn't have 'IF NOT EXISTS', so we might ignore some errors during schema setup
+                pass
 
 
 def fetch_query_result(cursor, sql):
     if not sql:
         return None
+    cursor.arraysize = FETCH_ARRAY_SIZE
+    cursor.prefetchrows = FETCH_ARRAY_SIZE
     cursor.execute(sql)
     cols = [d[0] for d in cursor.description]
-    rows = cursor.fetchall()
+    # Rows in the order the database returned them, so logs show any ORDER BY
+    rows = list(cursor)
     return cols, rows
 
 
 def normalize_result(cols, rows):
+    # The fetched list is kept for the logs; the frozenset is what
+    # diff_results compares, so no sort is needed for either
     if rows is None:
         return None
-    return cols, sorted(rows)
+    return cols, rows, frozenset(rows)
 
 
-def pretty_result(cols, rows):
-    if rows is None:
-        return "NO RESULT"
-    return {
-        "columns": cols,
-        "rows": rows
-    }
+def write_result(log, cols, rows):
+    # One row per line; unlike pformat there is no width fitting across rows
+    log.write("columns: ")
+    log.write(repr(cols))
+    log.write("\nrows:\n")
+    log.writelines(repr(row) + "\n" for row in rows)
 
 
 def diff_results(expected, actual):
@@ -75,8 +190,8 @@ def diff_results(expected, actual):
     if actual is None:
         return "No actual result provided (student query missing or failed)."
 
-    exp_cols, exp_rows = expected
-    act_cols, act_rows = actual
+    exp_cols, exp_rows, exp_set = expected
+    act_cols, act_rows, act_set = actual
 
     diff = []
 
@@ -87,15 +202,15 @@ def diff_results(expected, actual):
             f"Actual:   {act_cols}"
         )
 
-    # Convert rows (which are tuples) to sets for easier comparison
-    missing = set(exp_rows) - set(act_rows)
-    extra = set(act_rows) - set(exp_rows)
+    # Report differences in fetched order (once each) so logs are reproducible
+    missing = [row for row in dict.fromkeys(exp_rows) if row not in act_set]
+    extra = [row for row in dict.fromkeys(act_rows) if row not in exp_set]
 
     if missing:
-        diff.append(f"Missing rows:\n{pformat(missing)}")
+        diff.append("Missing rows:\n" + "\n".join(map(repr, missing)))
 
     if extra:
-        diff.append(f"Extra rows:\n{pformat(extra)}")
+        diff.append("Extra rows:\n" + "\n".join(map(repr, extra)))
 
     return "\n\n".join(diff)
 
@@ -109,127 +224,252 @@ def drop_all_tables(cursor):
             pass
 
 
-def parse_queries(content, expected_count):
-    queries = {}
-    for i in range(1, expected_count + 1):
-        # Look for --N-- followed by anything until the next --M-- or end of file
-        marker = f"--{i}--"
-        pattern = rf"{marker}\s*(.*?)\s*(?=--\d+--|$)"
-        match = re.search(pattern, content, re.DOTALL)
-        if match:
-            queries[i] = match.group(1).strip()
-        else:
-            queries[i] = None
-    return queries
+def reset_schema(conn, cursor):
+    drop_all_tables(cursor)
+    run_sql_script(cursor, SCHEMA_FILE)
+    conn.commit()
 
 
-def main():
-    os.makedirs(LOGS_DIR, exist_ok=True)
+def first_keyword(sql):
+    # Skip blank and comment lines; the first word decides the statement kind
+    for line in sql.splitlines():
+        line = line.strip().lstrip("(")
+        if line and not line.startswith("--"):
+            return line.split(None, 1)[0].lower()
+    return ""
+
+
+def run_query(conn, cursor, sql):
+    # The schema is committed once per worker; every query must leave it as found
+    keyword = first_keyword(sql)
+    try:
+        return fetch_query_result(cursor, sql)
+    finally:
+        conn.rollback()
+        if keyword not in READ_ONLY_KEYWORDS and keyword not in DML_KEYWORDS:
+            # DDL commits implicitly, so only a rebuild restores the schema
+            reset_schema(conn, cursor)
+
+
+def fetch_batched_results(conn, cursor, queries):
+    # Open every read-only query as a REF CURSOR from one anonymous block, so a
+    # student costs one round-trip instead of one per query. Returns {} when
+    # there is nothing to batch or the block fails; callers then run each
+    # query on its own, which also attributes any error to the right query.
+    selects = {
+        i: sql.rstrip().rstrip(";")
+        for i, sql in queries.items()
+        if sql and first_keyword(sql) in READ_ONLY_KEYWORDS
+    }
+    if len(selects) < 2:
+        return {}
+
+    ref_cursors = {}
+    for i in selects:
+        ref = conn.cursor()
+        ref.arraysize = FETCH_ARRAY_SIZE
+        ref.prefetchrows = FETCH_ARRAY_SIZE
+        ref_cursors[f"c{i}"] = ref
+
+    opens = "\n".join(
+        "OPEN :c{} FOR '{}';".format(i, sql.replace("'", "''"))
+        for i, sql in selects.items()
+    )
+    try:
+        cursor.execute(f"BEGIN\n{opens}\nEND;", ref_cursors)
+        results = {}
+        for i in selects:
+            ref = ref_cursors[f"c{i}"]
+            results[i] = [d[0] for d in ref.description], list(ref)
+        return results
+    except Exception:
+        return {}
+    finally:
+        conn.rollback()
+        for ref in ref_cursors.values():
+            ref.close()
+
+
+def parse_queries_cached(content, expected_count):
+    key = (hashlib.sha1(content.encode("utf-8")).digest(), expected_count)
+    queries = _parse_cache.get(key)
+    if queries is None:
+        queries = _parse_cache[key] = parse_queries(content, expected_count)
+    return queries
 
-    conn = connect()
-    cursor = conn.cursor()
 
-    results = []
+def read_student_queries(file):
+    # Uploads are stored as raw bytes; only the query bodies must be valid UTF-8
+    with open(os.path.join(QUERIES_DIR, file), "r", encoding="utf-8", errors="replace") as f:
+        student_content = f.read()
+    return parse_queries_cached(student_content, EXPECTED_QUERIES)
 
-    # ---------- Compute expected outputs ----------
-    print("Pre-computing expected results from model solution...")
-    with open(MODEL_FILE, "r", encoding="utf-8") as f:
-        model_content = f.read()
 
-    model_queries = parse_queries(model_content, EXPECTED_QUERIES)
-    expected_results = {}
+def submission_key(student_queries):
+    # Students whose parsed queries are identical get identical results
+    bodies = [student_queries[i] for i in range(1, EXPECTED_QUERIES + 1)]
+    return blake3(orjson.dumps(bodies)).digest()
 
-    for i in range(1, EXPECTED_QUERIES + 1):
-        drop_all_tables(cursor)
-        run_sql_script(cursor, SCHEMA_FILE)
-        
-        sql = model_queries.get(i)
-        if sql:
-            try:
-                exp_cols, exp_rows = fetch_query_result(cursor, sql)
-                expected_results[i] = normalize_result(exp_cols, exp_rows)
-            except Exception as e:
-                print(f"Error in model solution Query {i}: {e}")
-                expected_results[i] = None
-        else:
-            print(f"Warning: Model query {i} not found in {MODEL_FILE}")
-            expected_results[i] = None
 
-    conn.commit()
-    drop_all_tables(cursor)
-    conn.commit()
+def evaluate_submission(pool, worker_users, student_ids, student_queries, expected_results):
+    student_scores = {}
+    body = io.StringIO()
 
-    # ---------- Evaluate students ----------
-    for file in sorted(os.listdir(QUERIES_DIR)):
-        if not file.endswith(".sql"):
-            continue
-
-        student_id = file.replace(".sql", "")
-        log_path = os.path.join(LOGS_DIR, f"{student_id}.log")
+    # Borrow a schema nobody else is using for the duration of this submission
+    user = worker_users.get()
+    try:
+        with pool.acquire(user=user, password=WORKER_PASSWORD) as conn:
+            cursor = conn.cursor()
 
-        print(f"\nEvaluating student: {student_id}")
-        
-        student_scores = {}
-        
-        with open(os.path.join(QUERIES_DIR, file), "r", encoding="utf-8") as f:
-            student_content = f.read()
-        
-        student_queries = parse_queries(student_content, EXPECTED_QUERIES)
-
-        with open(log_path, "w", encoding="utf-8") as log:
-            log.write(f"STUDENT ID: {student_id}\n")
-            log.write("=" * 30 + "\n\n")
+            # Read-only queries missing from the batch fall back to run_query below
+            batched = fetch_batched_results(conn, cursor, student_queries)
 
             for i in range(1, EXPECTED_QUERIES + 1):
-                log.write(f"--- QUERY {i} ---\n")
+                body.write(f"--- QUERY {i} ---\n")
                 status = "FAIL"
                 try:
-                    # Fresh schema for each query to avoid side effects
-                    drop_all_tables(cursor)
-                    run_sql_script(cursor, SCHEMA_FILE)
-
                     sql = student_queries.get(i)
                     if not sql:
-                        log.write("STATUS: FAIL (Marker not found or empty)\n\n")
+                        body.write("STATUS: FAIL (Marker not found or empty)\n\n")
                     else:
-                        act_cols, act_rows = fetch_query_result(cursor, sql)
+                        if i in batched:
+                            act_cols, act_rows = batched[i]
+                        else:
+                            act_cols, act_rows = run_query(conn, cursor, sql)
                         actual = normalize_result(act_cols, act_rows)
                         expected = expected_results.get(i)
 
                         diff = diff_results(expected, actual)
 
-                        log.write("EXPECTED OUTPUT:\n")
-                        log.write(pformat(pretty_result(*expected)) if expected else "N/A")
-                        log.write("\n\n")
+                        body.write("EXPECTED OUTPUT:\n")
+                        if expected:
+                            write_result(body, *expected[:2])
+                        else:
+                            body.write("N/A\n")
+                        body.write("\n")
 
-                        log.write("STUDENT OUTPUT:\n")
-                        log.write(pformat(pretty_result(*actual)))
-                        log.write("\n\n")
+                        body.write("STUDENT OUTPUT:\n")
+                        write_result(body, *actual[:2])
+                        body.write("\n")
 
                         if diff:
-                            log.write("DIFF:\n")
-                            log.write(diff + "\n")
+                            body.write("DIFF:\n")
+                            body.write(diff + "\n")
                         else:
                             status = "PASS"
-                            log.write("RESULT: PASS\n")
-                        
+                            body.write("RESULT: PASS\n")
+
                 except Exception as e:
-                    log.write("SQL ERROR:\n")
-                    log.write(str(e) + "\n\n")
-                    log.write(traceback.format_exc() + "\n")
-                
+                    body.write("SQL ERROR:\n")
+                    body.write(str(e) + "\n\n")
+                    body.write(traceback.format_exc() + "\n")
+
                 student_scores[f"Q{i}"] = status
-                log.write(f"FINAL STATUS: {status}\n")
-                log.write("-" * 20 + "\n\n")
+                body.write(f"FINAL STATUS: {status}\n")
+                body.write("-" * 20 + "\n\n")
+    finally:
+        worker_users.put(user)
+
+    pass_count = list(student_scores.values()).count("PASS")
+    scores = [student_scores[f"Q{i}"] for i in range(1, EXPECTED_QUERIES + 1)]
+
+    rows = []
+    for student_id in student_ids:
+        with open(os.path.join(LOGS_DIR, f"{student_id}.log"), "w", encoding="utf-8") as log:
+            log.write(f"STUDENT ID: {student_id}\n")
+            log.write("=" * 30 + "\n\n")
+            log.write(body.getvalue())
+
+        # One print per student so parallel workers don't interleave lines
+        print(f"\nEvaluating student: {student_id}\n➡ Score: {pass_count}/{EXPECTED_QUERIES}")
+        rows.append([student_id] + scores + [f"{pass_count}/{EXPECTED_QUERIES}"])
+    return rows
+
+
+def main():
+    os.makedirs(LOGS_DIR, exist_ok=True)
+
+    conn = connect()
+    cursor = conn.cursor()
+    users = create_worker_users(cursor)
+    cursor.close()
+    conn.close()
+
+    pool = create_pool()
+    worker_users = queue.Queue()
+    for user in users:
+        worker_users.put(user)
+
+    # ---------- Compute expected outputs ----------
+    print("Pre-computing expected results from model solution...")
+    with open(MODEL_FILE, "r", encoding="utf-8") as f:
+        model_content = f.read()
+
+    model_queries = parse_queries_cached(model_content, EXPECTED_QUERIES)
+    expected_results = {}
+
+    with pool.acquire(user=users[0], password=WORKER_PASSWORD) as conn:
+        cursor = conn.cursor()
+
+        # Pure SELECT/WITH model queries can't change the schema, so one build serves them all
+        model_read_only = all(
+            first_keyword(sql) in READ_ONLY_KEYWORDS for sql in model_queries.values() if sql
+        )
+        if model_read_only:
+            drop_all_tables(cursor)
+            run_sql_script(cursor, SCHEMA_FILE)
+        else:
+            print("Model solution has non-SELECT queries; rebuilding the schema before each one.")
 
-        pass_count = list(student_scores.values()).count("PASS")
-        print(f"➡ Score: {pass_count}/{EXPECTED_QUERIES}")
-        
-        row = [student_id]
         for i in range(1, EXPECTED_QUERIES + 1):
-            row.append(student_scores[f"Q{i}"])
-        row.append(f"{pass_count}/{EXPECTED_QUERIES}")
-        results.append(row)
+            if not model_read_only:
+                drop_all_tables(cursor)
+                run_sql_script(cursor, SCHEMA_FILE)
+
+            sql = model_queries.get(i)
+            if sql:
+                try:
+                    exp_cols, exp_rows = fetch_query_result(cursor, sql)
+                    expected_results[i] = normalize_result(exp_cols, exp_rows)
+                except Exception as e:
+                    print(f"Error in model solution Query {i}: {e}")
+                    expected_results[i] = None
+            else:
+                print(f"Warning: Model query {i} not found in {MODEL_FILE}")
+                expected_results[i] = None
+
+        conn.commit()
+
+    # ---------- Build each worker's schema once ----------
+    for user in users:
+        with pool.acquire(user=user, password=WORKER_PASSWORD) as conn:
+            reset_schema(conn, conn.cursor())
+
+    # ---------- Evaluate students ----------
+    files = [f for f in sorted(os.listdir(QUERIES_DIR)) if f.endswith(".sql")]
+
+    # Identical submissions are evaluated once and the result shared by the group
+    groups = {}
+    for file in files:
+        student_queries = read_student_queries(file)
+        key = submission_key(student_queries)
+        if key not in groups:
+            groups[key] = (student_queries, [])
+        groups[key][1].append(file.replace(".sql", ""))
+
+    if len(groups) < len(files):
+        print(f"{len(files)} submissions, {len(groups)} distinct; evaluating each distinct one once.")
+        # Instructor-only: student logs never name other students
+        for _, student_ids in groups.values():
+            if len(student_ids) > 1:
+                print(f"Identical queries: {', '.join(student_ids)}")
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        group_rows = executor.map(
+            lambda group: evaluate_submission(pool, worker_users, group[1], group[0], expected_results),
+            groups.values()
+        )
+        results = sorted((row for rows in group_rows for row in rows), key=lambda row: row[0])
 
     # ---------- Export CSV ----------
     with open(OUTPUT_CSV, "w", newline="", encoding="utf-8") as f:
@@ -238,8 +478,7 @@ def main():
         writer.writerow(header)
         writer.writerows(results)
 
-    cursor.close()
-    conn.close()
+    pool.close()
 
     print(f"\nEvaluation complete. Results written to {OUTPUT_CSV}")
 